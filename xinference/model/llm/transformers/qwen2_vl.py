@@ -11,13 +11,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
 import importlib.util
+import json
 import logging
+import queue
 import sys
+import threading
+import time
 import uuid
-from typing import Iterator, List, Optional, Union
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Deque, Dict, Iterator, List, Optional, Union
 
-from ....device_utils import is_npu_available
+import torch
+from transformers.generation.stopping_criteria import (
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
+
+from ....core.scheduler import InferenceRequest
+from ....device_utils import get_device_preferred_dtype, is_npu_available
 from ....model.utils import select_device
 from ....types import (
     ChatCompletion,
@@ -33,6 +49,145 @@ from .utils import cache_clean
 
 logger = logging.getLogger(__name__)
 
+# Number of preprocessed inputs kept, so that repeated requests
+# with identical messages skip decoding and resizing the images again.
+PREPARED_INPUTS_CACHE_SIZE = 8
+# Max seconds a decoded text waits to be joined with the following ones
+# into one streaming chunk, short enough to be unnoticeable.
+STREAM_CHUNK_MAX_DELAY = 0.005
+# Min seconds to wait for the next decoded text before a streaming request times out,
+# raised by the estimated generation time for long prompts and outputs.
+MIN_STREAM_TIMEOUT = 60.0
+
+
+class IncrementalTextStreamer(BaseStreamer):
+    """
+    Streamer that yields the text of every new token as soon as it is decoded.
+    Unlike `TextIteratorStreamer`, which holds text back until a space or a line break,
+    only an incomplete UTF-8 character is held back.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        timeout: Optional[float] = None,
+        skip_prompt: bool = False,
+        **decode_kwargs,
+    ):
+        self.tokenizer = tokenizer
+        self.timeout = timeout
+        self.skip_prompt = skip_prompt
+        self.decode_kwargs = decode_kwargs
+        self.next_tokens_are_prompt = True
+        self.token_ids: List[int] = []
+        # only the tokens from `prefix_offset` are decoded for each new token,
+        # text of the tokens before `read_offset` has been emitted
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text_queue: queue.Queue = queue.Queue()
+        self.stop_signal = None
+
+    def _decode_delta(self, final: bool = False) -> Optional[str]:
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset : self.read_offset],
+            **self.decode_kwargs,
+        )
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset :], **self.decode_kwargs
+        )
+        # an incomplete character is decoded as "\ufffd", wait for the next token
+        if len(new_text) > len(prefix_text) and (
+            final or not new_text.endswith("\ufffd")
+        ):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text) :]
+        return None
+
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("IncrementalTextStreamer only supports batch size 1")
+        elif len(value.shape) > 1:
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        self.token_ids.extend(value.tolist())
+        text = self._decode_delta()
+        if text:
+            self.text_queue.put(text, timeout=self.timeout)
+
+    def end(self):
+        # flush the text held back
+        text = self._decode_delta(final=True)
+        if text:
+            self.text_queue.put(text, timeout=self.timeout)
+        self.next_tokens_are_prompt = True
+        self.text_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value == self.stop_signal:
+            raise StopIteration()
+        return value
+
+    def iter_chunks(self, max_texts: int, max_delay: float) -> Iterator[str]:
+        """
+        Join up to `max_texts` decoded texts into one chunk,
+        a chunk is yielded earlier if its first text has waited for `max_delay` seconds.
+        """
+        buffer: Deque[str] = deque()
+        deadline = None
+        while True:
+            if deadline is None:
+                value = self.text_queue.get(timeout=self.timeout)
+            else:
+                try:
+                    value = self.text_queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    yield "".join(buffer)
+                    buffer.clear()
+                    deadline = None
+                    continue
+
+            if value == self.stop_signal:
+                if buffer:
+                    yield "".join(buffer)
+                return
+            buffer.append(value)
+            if deadline is None:
+                deadline = time.monotonic() + max_delay
+            if len(buffer) >= max_texts:
+                yield "".join(buffer)
+                buffer.clear()
+                deadline = None
+
+
+class CancelledStoppingCriteria(StoppingCriteria):
+    """
+    Stop generating once `cancelled` is set, e.g. the stream is closed by the client.
+    """
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ):
+        return torch.full(
+            (input_ids.shape[0],),
+            self.cancelled.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
 
 @register_transformer
 @register_non_default_model("qwen2-vl-instruct", "qwen2.5-vl-instruct")
@@ -43,6 +198,16 @@ class Qwen2VLChatModel(PytorchChatModel):
         self._model = None
         self._device = None
         self._processor = None
+        self._process_vision_info = None
+        self._attn_implementation = None
+        self._h2d_stream = None
+        self._vision_stream = None
+        # seconds per token, measured at load
+        self._prefill_token_time: Optional[float] = None
+        self._decode_token_time: Optional[float] = None
+        self._generate_executor: Optional[ThreadPoolExecutor] = None
+        self._inputs_cache: OrderedDict = OrderedDict()
+        self._inputs_cache_lock = threading.Lock()
 
     def _sanitize_model_config(
         self, pytorch_model_config: Optional[PytorchModelConfig]
@@ -51,6 +216,11 @@ class Qwen2VLChatModel(PytorchChatModel):
         assert pytorch_model_config is not None
         pytorch_model_config.setdefault("min_pixels", 256 * 28 * 28)
         pytorch_model_config.setdefault("max_pixels", 1280 * 28 * 28)
+        pytorch_model_config.setdefault("quantization_config", None)
+        pytorch_model_config.setdefault("vision_quant_mode", "none")
+        pytorch_model_config.setdefault("static_kv_cache", False)
+        pytorch_model_config.setdefault("enable_cuda_graph", False)
+        pytorch_model_config.setdefault("compile_vision_encoder", False)
         return pytorch_model_config
 
     @classmethod
@@ -69,13 +239,25 @@ class Qwen2VLChatModel(PytorchChatModel):
         return False
 
     def load(self):
-        from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+        from transformers import Qwen2VLForConditionalGeneration
 
         try:
             from transformers import Qwen2_5_VLForConditionalGeneration
         except ImportError:
             Qwen2_5_VLForConditionalGeneration = None
 
+        # import on load instead of with the module, importing torchvision may fail
+        # with errors other than ImportError and break the registration of all models
+        try:
+            from qwen_vl_utils import process_vision_info
+        except ImportError:
+            raise ImportError(
+                "Failed to import 'process_vision_info' from 'qwen_vl_utils'. "
+                "Please make sure 'qwen_vl_utils' is installed. "
+                "You can install it by `pip install qwen-vl-utils`\n"
+            )
+        self._process_vision_info = process_vision_info
+
         device = self._pytorch_model_config.get("device", "auto")
         device = select_device(device)
         self._device = device
@@ -83,14 +265,24 @@ class Qwen2VLChatModel(PytorchChatModel):
         device = "auto" if device == "cuda" else device
         min_pixels = self._pytorch_model_config.get("min_pixels")
         max_pixels = self._pytorch_model_config.get("max_pixels")
-        self._processor = AutoProcessor.from_pretrained(
-            self.model_path,
-            trust_remote_code=True,
-            min_pixels=min_pixels,
-            max_pixels=max_pixels,
+        # the fast image processor rescales, normalizes and patchifies images
+        # with torchvision, which can run on GPU
+        use_fast = (
+            self._device == "cuda"
+            and importlib.util.find_spec("torchvision") is not None
+        )
+        self._processor = self._get_processor(
+            self.model_path, min_pixels, max_pixels, use_fast
         )
         self._tokenizer = self._processor.tokenizer
-        flash_attn_installed = importlib.util.find_spec("flash_attn") is not None
+        if self._device == "cuda":
+            # a side stream to copy inputs to device without blocking the default stream
+            self._h2d_stream = torch.cuda.Stream()
+            # a side stream to run the vision encoder along with the text embeddings
+            self._vision_stream = torch.cuda.Stream()
+            # use TF32 tensor cores for the remaining fp32 matmuls
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
         llm_family = self.model_family.model_family or self.model_family.model_name
         model_cls = (
             Qwen2_5_VLForConditionalGeneration
@@ -99,26 +291,256 @@ class Qwen2VLChatModel(PytorchChatModel):
         )
         if model_cls is None:
             raise ImportError("`transformers` version is too old, please upgrade it")
-        if flash_attn_installed:
-            self._model = model_cls.from_pretrained(
-                self.model_path,
-                torch_dtype="bfloat16",
-                device_map=device,
-                attn_implementation="flash_attention_2",
-                trust_remote_code=True,
-            ).eval()
+        flash_attn_implementation = self._get_flash_attn_implementation(model_cls)
+        kwargs = {}
+        if flash_attn_implementation is not None:
+            self._attn_implementation = flash_attn_implementation
+            kwargs["torch_dtype"] = torch.bfloat16
         elif is_npu_available():
             # Ascend do not support bf16
-            self._model = model_cls.from_pretrained(
-                self.model_path,
-                device_map="auto",
-                trust_remote_code=True,
-                torch_dtype="float16",
-            ).eval()
+            device = "auto"
+            kwargs["torch_dtype"] = torch.float16
         else:
-            self._model = model_cls.from_pretrained(
-                self.model_path, device_map=device, trust_remote_code=True
-            ).eval()
+            # let PyTorch dispatch to the fused flash / memory efficient kernels
+            # instead of the eager attention when flash_attn is not installed
+            self._attn_implementation = "sdpa"
+            if self._device == "cuda":
+                # Ampere and later GPUs run bf16 natively
+                kwargs["torch_dtype"] = (
+                    torch.bfloat16
+                    if torch.cuda.get_device_capability()[0] >= 8
+                    else get_device_preferred_dtype(self._device)
+                )
+        if self._attn_implementation is not None:
+            kwargs["attn_implementation"] = self._attn_implementation
+        quantization_config = self._get_quantization_config(
+            kwargs.get("torch_dtype", get_device_preferred_dtype(self._device))
+        )
+        if quantization_config is not None:
+            kwargs["quantization_config"] = quantization_config
+        logger.debug("Loading model with extra kwargs: %s", kwargs)
+        self._model = model_cls.from_pretrained(
+            self.model_path,
+            device_map=device,
+            trust_remote_code=True,
+            **kwargs,
+        ).eval()
+        if self._pytorch_model_config.get("enable_cuda_graph"):
+            self._enable_cuda_graph()
+        elif self._pytorch_model_config.get("static_kv_cache"):
+            self._enable_static_kv_cache(compile_decoding=False)
+        if self._pytorch_model_config.get("compile_vision_encoder"):
+            self._compile_vision_encoder()
+        self._measure_token_time()
+
+    def _measure_token_time(self):
+        """
+        Measure the time to prefill and decode a token by short generations,
+        the first one also warms up the kernels and compiles the decoding step if enabled.
+        """
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Hello"}]}]
+        inputs = self._to_device(self._prepare_inputs(messages))
+
+        def timed_generate(max_new_tokens: int) -> float:
+            start = time.perf_counter()
+            self._run_generate(
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                use_cache=True,
+                **inputs,
+            )
+            return time.perf_counter() - start
+
+        timed_generate(4)
+        prefill_time = timed_generate(1)
+        decode_time = max(timed_generate(4) - prefill_time, 0)
+        self._prefill_token_time = prefill_time / inputs.input_ids.shape[1]
+        self._decode_token_time = decode_time / 3
+        logger.debug(
+            "Measured %.4fs per prefill token, %.4fs per decode token",
+            self._prefill_token_time,
+            self._decode_token_time,
+        )
+
+    def _get_stream_timeout(self, prompt_len: int, max_new_tokens: int) -> float:
+        if self._prefill_token_time is None or self._decode_token_time is None:
+            return MIN_STREAM_TIMEOUT
+        estimated = (
+            prompt_len * self._prefill_token_time
+            + max_new_tokens * self._decode_token_time
+        )
+        return max(MIN_STREAM_TIMEOUT, estimated)
+
+    def stop(self):
+        if self._generate_executor is not None:
+            self._generate_executor.shutdown(wait=False, cancel_futures=True)
+            self._generate_executor = None
+
+    def _get_flash_attn_implementation(self, model_cls) -> Optional[str]:
+        """
+        Flash-Attention 3 is faster than 2 on Hopper GPUs,
+        use it when it's installed and supported by the model class in transformers.
+        """
+        if self._device == "cuda" and torch.cuda.get_device_capability()[0] == 9:
+            try:
+                from transformers.utils import is_flash_attn_3_available
+            except ImportError:
+                # transformers is too old to dispatch to Flash-Attention 3
+                pass
+            else:
+                # `_supports_flash_attn` covers all the versions since transformers 4.54,
+                # before it the models opt in by `_supports_flash_attn_3`
+                if is_flash_attn_3_available() and (
+                    getattr(model_cls, "_supports_flash_attn_3", False)
+                    or getattr(model_cls, "_supports_flash_attn", False)
+                ):
+                    return "flash_attention_3"
+        if importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return None
+
+    @classmethod
+    @lru_cache(maxsize=8)
+    def _get_processor(
+        cls, model_path: str, min_pixels: int, max_pixels: int, use_fast: bool
+    ):
+        """
+        The processor is read-only after loaded,
+        share it between the model instances of the same path in the process.
+        """
+        from transformers import AutoProcessor
+
+        kwargs = {"use_fast": True} if use_fast else {}
+        return AutoProcessor.from_pretrained(
+            model_path,
+            trust_remote_code=True,
+            min_pixels=min_pixels,
+            max_pixels=max_pixels,
+            **kwargs,
+        )
+
+    def _enable_static_kv_cache(self, compile_decoding: bool = True) -> bool:
+        """
+        Preallocate the kv cache for the prompt and `max_new_tokens` in `generate`,
+        instead of growing it by concatenation at every decoding step.
+        The cache is kept by the model and reused while requests fit in it,
+        so all generations run one by one in the same thread.
+        On CUDA, `generate` compiles the decoding step with CUDA graphs
+        whenever the cache is static, unless `compile_decoding` is False.
+        """
+        # `_supports_static_cache` is replaced by `_can_compile_fullgraph`
+        # since transformers 4.54
+        if not (
+            getattr(self._model, "_can_compile_fullgraph", False)
+            or getattr(self._model, "_supports_static_cache", False)
+        ):
+            logger.warning(
+                "Static kv cache is not supported by %s "
+                "in the installed transformers, fall back to the dynamic kv cache",
+                type(self._model).__name__,
+            )
+            return False
+        generation_config = self._model.generation_config
+        generation_config.cache_implementation = "static"
+        if not compile_decoding:
+            generation_config.disable_compile = True
+        # `generate` resets the shared cache in every call,
+        # concurrent requests would overwrite the kv cache of each other
+        if self._generate_executor is None:
+            self._generate_executor = ThreadPoolExecutor(max_workers=1)
+        return True
+
+    def _enable_cuda_graph(self):
+        """
+        Decode with a static kv cache and replay the decoding step by CUDA graphs,
+        for batch size 1 the kernel launch overhead dominates the decoding.
+        """
+        if self._device != "cuda":
+            logger.warning(
+                "CUDA graph is only supported on CUDA devices, got %s", self._device
+            )
+            return
+        try:
+            from transformers import CompileConfig
+        except ImportError:
+            logger.warning(
+                "CUDA graph requires transformers>=4.48 to compile the decoding step, "
+                "please upgrade it"
+            )
+            return
+
+        # `generate` compiles the decoding step when the cache is static,
+        # the vision encoder only runs in prefill and is left uncompiled
+        if not self._enable_static_kv_cache():
+            return
+        # CUDA graphs are recorded per thread,
+        # the static kv cache already makes `generate` run in the same thread
+        self._model.generation_config.compile_config = CompileConfig(
+            mode="reduce-overhead", fullgraph=True
+        )
+
+    def _compile_vision_encoder(self):
+        """
+        The vision encoder runs once per image in prefill and is dominated by the matmuls
+        over image patches, compile it by inductor with autotuned GEMM kernels.
+        The number of patches varies with images, so compile with dynamic shapes,
+        and without CUDA graphs, which would be recorded for every shape.
+        """
+        import torch._inductor.config as inductor_config
+
+        # pad GEMM dimensions to keep the tensor cores busy
+        inductor_config.shape_padding = True
+        # compile in place, `visual` is a read-only property in newer transformers
+        self._model.visual.compile(mode="max-autotune-no-cudagraphs", dynamic=True)
+
+    def _get_quantization_config(self, compute_dtype: torch.dtype):
+        """
+        Build the bitsandbytes config for `4-bit` / `8-bit` quantization of pytorch models,
+        or from the `quantization_config` passed by user.
+        By default, only the language model is quantized. The vision encoder,
+        which is small but runs on every pixel, stays in half precision
+        unless `vision_quant_mode` is `same`.
+        """
+        quantization_config = self._pytorch_model_config.get("quantization_config")
+        if quantization_config is None:
+            if self.model_spec.model_format != "pytorch":
+                return None
+            if self.quantization == "4-bit":
+                quantization_config = {
+                    "load_in_4bit": True,
+                    "bnb_4bit_compute_dtype": compute_dtype,
+                    "bnb_4bit_quant_type": "nf4",
+                    "bnb_4bit_use_double_quant": True,
+                }
+            elif self.quantization == "8-bit":
+                quantization_config = {"load_in_8bit": True}
+            elif self.quantization == "none":
+                return None
+            else:
+                raise ValueError(
+                    f"Quantization {self.quantization} is not supported in temporary"
+                )
+
+        if not (self._device == "cuda" and self._is_linux()):
+            raise ValueError(
+                "Quantization by bitsandbytes is only supported on cuda device of linux"
+            )
+
+        from transformers import BitsAndBytesConfig
+
+        quantization_config = dict(quantization_config)
+        vision_quant_mode = self._pytorch_model_config.get("vision_quant_mode")
+        if vision_quant_mode == "none":
+            quantization_config.setdefault(
+                "llm_int8_skip_modules", ["visual", "lm_head"]
+            )
+        elif vision_quant_mode != "same":
+            raise ValueError(
+                f"Invalid vision_quant_mode: {vision_quant_mode}, "
+                f"only `none` and `same` are supported"
+            )
+        return BitsAndBytesConfig(**quantization_config)
 
     @cache_clean
     def chat(
@@ -139,35 +561,172 @@ class Qwen2VLChatModel(PytorchChatModel):
             c = self._generate(messages, generate_config)
             return c
 
+    def _get_inputs_cache_key(self, messages: List) -> Optional[str]:
+        """
+        Hash the messages when all images and videos are inline data URIs,
+        which carry the bytes themselves.
+        A URL or a file path may be overwritten by a new image, do not cache it.
+        """
+        for msg in messages:
+            for c in msg["content"]:
+                if c["type"] in ("image", "video"):
+                    data = c[c["type"]]
+                    if not (isinstance(data, str) and data.startswith("data:")):
+                        return None
+        payload = json.dumps(
+            [
+                messages,
+                self._pytorch_model_config.get("min_pixels"),
+                self._pytorch_model_config.get("max_pixels"),
+            ],
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _set_image_pixel_bounds(self, messages: List) -> List:
+        """
+        qwen_vl_utils resizes images by its own default pixel bounds,
+        then the processor resizes them again by the bounds of the model.
+        Pass the bounds of the model to resize each image only once.
+        """
+        bounds = {
+            "min_pixels": self._pytorch_model_config.get("min_pixels"),
+            "max_pixels": self._pytorch_model_config.get("max_pixels"),
+        }
+        return [
+            {
+                **msg,
+                "content": [
+                    {**bounds, **c} if c["type"] == "image" else c
+                    for c in msg["content"]
+                ],
+            }
+            for msg in messages
+        ]
+
+    def _prepare_inputs(self, messages: List):
+        """
+        Apply the chat template and process the vision info of messages.
+        The result is cached on host when the vision data of messages is inline,
+        use `_to_device` to get the inputs for generation.
+        """
+        key = self._get_inputs_cache_key(messages)
+        if key is not None:
+            with self._inputs_cache_lock:
+                inputs = self._inputs_cache.get(key)
+                if inputs is not None:
+                    self._inputs_cache.move_to_end(key)
+                    return inputs
+
+        has_vision = any(
+            c["type"] in ("image", "video") for msg in messages for c in msg["content"]
+        )
+        if not has_vision:
+            # no vision pad tokens to expand, render and tokenize the prompt in one call
+            inputs = self._processor.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt",
+            )
+        else:
+            text = self._processor.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=True
+            )
+            image_inputs, video_inputs = self._process_vision_info(
+                self._set_image_pixel_bounds(messages)
+            )
+            processor_kwargs = {}
+            if type(self._processor.image_processor).__name__.endswith("Fast"):
+                # preprocess images on device instead of traversing pixels on CPU
+                processor_kwargs["device"] = self._device
+            # the processor needs the rendered prompt
+            # to repeat the vision pad tokens by the grid size of each image
+            inputs = self._processor(
+                text=[text],
+                images=image_inputs,
+                videos=video_inputs,
+                padding=True,
+                return_tensors="pt",
+                **processor_kwargs,
+            )
+        if self._device == "cuda":
+            # pinned memory makes the host to device copy asynchronous
+            for k, v in inputs.items():
+                if not isinstance(v, torch.Tensor):
+                    continue
+                if v.device.type == "cpu":
+                    inputs[k] = v.pin_memory()
+                elif key is not None:
+                    # pixel values preprocessed on GPU would be held by the cache,
+                    # out of reach of `empty_cache`
+                    inputs[k] = v.cpu().pin_memory()
+
+        if key is not None:
+            with self._inputs_cache_lock:
+                self._inputs_cache[key] = inputs
+                while len(self._inputs_cache) > PREPARED_INPUTS_CACHE_SIZE:
+                    self._inputs_cache.popitem(last=False)
+        return inputs
+
+    def _to_device(self, inputs):
+        from transformers import BatchFeature
+
+        stream = self._h2d_stream
+        # do not use `BatchFeature.to`, it replaces the cached host tensors in place,
+        # and `torch.cuda.stream(None)` is a no-op
+        with torch.cuda.stream(stream):
+            data = {
+                k: (
+                    v.to(self._device, non_blocking=True)
+                    if isinstance(v, torch.Tensor)
+                    else v
+                )
+                for k, v in inputs.items()
+            }
+        if stream is not None:
+            # kernels of `generate` are queued on the current stream,
+            # make them wait for the copies instead of synchronizing the host
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(stream)
+            for v in data.values():
+                if isinstance(v, torch.Tensor):
+                    v.record_stream(current_stream)
+        return BatchFeature(data)
+
+    def _model_generate(self, **kwargs):
+        # inference mode skips the version counting and view tracking of autograd,
+        # which `no_grad` in `generate` still does for every tensor
+        with torch.inference_mode():
+            return self._model.generate(**kwargs)
+
+    def _run_generate(self, **kwargs):
+        if self._generate_executor is not None:
+            return self._generate_executor.submit(
+                self._model_generate, **kwargs
+            ).result()
+        return self._model_generate(**kwargs)
+
     def _generate(
         self, messages: List, config: PytorchGenerateConfig = {}
     ) -> ChatCompletion:
-        from qwen_vl_utils import process_vision_info
-
         # Preparation for inference
-        text = self._processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self._processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to(self._device)
+        inputs = self._to_device(self._prepare_inputs(messages))
 
         # Inference: Generation of the output
-        generated_ids = self._model.generate(
+        gen_kwargs = {
+            "max_new_tokens": config.get("max_tokens", 512),
+            "temperature": config.get("temperature", 1),
+            "use_cache": True,
             **inputs,
-            max_new_tokens=config.get("max_tokens", 512),
-            temperature=config.get("temperature", 1),
-        )
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :]
-            for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+        }
+        generated_ids = self._run_generate(**gen_kwargs)
+        # prompts in a batch are padded to the same length
+        prompt_len = inputs.input_ids.shape[1]
+        generated_ids_trimmed = generated_ids[:, prompt_len:]
         output_text = self._processor.batch_decode(
             generated_ids_trimmed,
             skip_special_tokens=True,
@@ -178,62 +737,76 @@ class Qwen2VLChatModel(PytorchChatModel):
     def _generate_stream(
         self, messages: List, config: PytorchGenerateConfig = {}
     ) -> Iterator[CompletionChunk]:
-        from threading import Thread
-
-        from qwen_vl_utils import process_vision_info
-        from transformers import TextIteratorStreamer
-
-        text = self._processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self._processor(
-            text=[text],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
-        inputs = inputs.to(self._model.device)
+        inputs = self._to_device(self._prepare_inputs(messages))
 
+        max_new_tokens = config.get("max_tokens", 512)
+        # a long prefill of large images may exceed a fixed timeout on slow devices
+        timeout = self._get_stream_timeout(inputs.input_ids.shape[1], max_new_tokens)
         tokenizer = self._tokenizer
-        streamer = TextIteratorStreamer(
-            tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True
+        streamer = IncrementalTextStreamer(
+            tokenizer, timeout=timeout, skip_prompt=True, skip_special_tokens=True
         )
 
         gen_kwargs = {
-            "max_new_tokens": config.get("max_tokens", 512),
+            "max_new_tokens": max_new_tokens,
             "temperature": config.get("temperature", 1),
+            "use_cache": True,
             "streamer": streamer,
             **inputs,
         }
         error = None
+        started = threading.Event()
+        cancelled = threading.Event()
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [CancelledStoppingCriteria(cancelled)]
+        )
 
         def model_generate():
+            started.set()
             try:
-                return self._model.generate(**gen_kwargs)
+                return self._model_generate(**gen_kwargs)
             except Exception:
                 nonlocal error
                 error = sys.exc_info()
                 streamer.end()
                 raise
 
-        thread = Thread(target=model_generate)
-        thread.start()
-
-        completion_id = str(uuid.uuid1())
-        for new_text in streamer:
-            yield generate_completion_chunk(
-                chunk_text=new_text,
-                finish_reason=None,
-                chunk_id=completion_id,
-                model_uid=self.model_uid,
-                prompt_tokens=-1,
-                completion_tokens=-1,
-                total_tokens=-1,
-                has_choice=True,
-                has_content=True,
-            )
+        future = None
+        if self._generate_executor is not None:
+            future = self._generate_executor.submit(model_generate)
+        else:
+            thread = threading.Thread(target=model_generate)
+            thread.start()
+
+        completion_id = uuid.uuid4().hex
+        max_texts = config.get("stream_interval", 2)
+        try:
+            if future is not None:
+                # the generation may be queued behind others,
+                # start the timeout of streamer after it starts
+                while not started.wait(timeout=1):
+                    if future.cancelled():
+                        raise RuntimeError(
+                            f"Generation is cancelled, model: {self.model_uid}"
+                        )
+            for new_text in streamer.iter_chunks(max_texts, STREAM_CHUNK_MAX_DELAY):
+                yield generate_completion_chunk(
+                    chunk_text=new_text,
+                    finish_reason=None,
+                    chunk_id=completion_id,
+                    model_uid=self.model_uid,
+                    prompt_tokens=-1,
+                    completion_tokens=-1,
+                    total_tokens=-1,
+                    has_choice=True,
+                    has_content=True,
+                )
+        finally:
+            # stop generating for a closed stream, which would hold the GPU
+            # and the generate executor for the other requests
+            cancelled.set()
+            if future is not None:
+                future.cancel()
 
         if error:
             _, err, tb = error  # type: ignore
@@ -250,3 +823,113 @@ class Qwen2VLChatModel(PytorchChatModel):
             has_choice=True,
             has_content=False,
         )
+
+    def _get_full_prompt(self, messages: List[Dict], tools):
+        messages = self._transform_messages(messages)
+        for msg in messages:
+            for c in msg["content"]:
+                if c["type"] == "video":
+                    raise RuntimeError(
+                        f"Continuous batching does not support video inputs for this model: {self.model_uid}"
+                    )
+        return self._prepare_inputs(messages)
+
+    def build_prefill_inputs(self, prompts: List, req_list: List[InferenceRequest]):
+        """
+        Left pad the input ids of requests,
+        and concat the image patches of requests in the same order as the image tokens.
+        """
+        input_ids = []
+        for i, feature in enumerate(prompts):
+            req_list[i].prompt_tokens = feature["input_ids"][0].tolist()
+            input_ids.append(req_list[i].prompt_tokens)
+        max_length = max(len(ids) for ids in input_ids)
+        for i, ids in enumerate(input_ids):
+            padding_len = max_length - len(ids)
+            req_list[i].padding_len = padding_len
+            input_ids[i] = [0] * padding_len + ids
+
+        batch = {"input_ids": torch.as_tensor(input_ids)}
+        features_with_image = [p for p in prompts if "pixel_values" in p]
+        if features_with_image:
+            # cached features are on host,
+            # while the others may be preprocessed on device
+            batch["pixel_values"] = torch.cat(
+                [
+                    p["pixel_values"].to(self._device, non_blocking=True)
+                    for p in features_with_image
+                ]
+            )
+            batch["image_grid_thw"] = torch.cat(
+                [p["image_grid_thw"] for p in features_with_image]
+            )
+        return self._to_device(batch)
+
+    def build_prefill_kwargs(self, prompts: List, req_list: List[InferenceRequest]):
+        batch = self.build_prefill_inputs(prompts, req_list)
+        batch_size, seq_len = batch["input_ids"].shape
+        attention_mask = self.build_prefill_attention_mask(
+            batch_size, seq_len, req_list
+        )
+        batch["attention_mask"] = attention_mask
+        batch["position_ids"] = self._build_prefill_rope_position_ids(batch, req_list)
+        if self._vision_stream is not None and "pixel_values" in batch:
+            batch["inputs_embeds"] = self._build_prefill_inputs_embeds(batch)
+            for k in ("input_ids", "pixel_values", "image_grid_thw"):
+                batch.pop(k)
+        return batch
+
+    def _build_prefill_inputs_embeds(self, batch: Dict):
+        """
+        The image embeddings and the text embeddings are independent
+        until the image embeddings replace the embeddings of image tokens,
+        run the vision encoder on a side stream while embedding the text tokens.
+        """
+        visual = self._model.visual
+        current_stream = torch.cuda.current_stream()
+        # the inputs are ready on the current stream
+        self._vision_stream.wait_stream(current_stream)
+        with torch.cuda.stream(self._vision_stream):
+            image_embeds = visual(
+                batch["pixel_values"].type(visual.dtype),
+                grid_thw=batch["image_grid_thw"],
+            )
+        input_ids = batch["input_ids"]
+        inputs_embeds = self._model.get_input_embeddings()(input_ids)
+        current_stream.wait_stream(self._vision_stream)
+        image_embeds.record_stream(current_stream)
+
+        image_mask = (input_ids == self._model.config.image_token_id).unsqueeze(-1)
+        return inputs_embeds.masked_scatter(
+            image_mask.expand_as(inputs_embeds),
+            image_embeds.to(inputs_embeds.device, inputs_embeds.dtype),
+        )
+
+    def _build_prefill_rope_position_ids(
+        self, batch: Dict, reqs: List[InferenceRequest]
+    ):
+        """
+        Qwen2-VL uses 3D rotary position ids (temporal, height, width) for the image tokens,
+        so the positions of text tokens after images are not the token indexes.
+        Record the `max_position_id` on request for the decode phase.
+        """
+        # moved to the inner model in newer transformers
+        get_rope_index = getattr(self._model, "get_rope_index", None)
+        if get_rope_index is None:
+            get_rope_index = self._model.model.get_rope_index
+        position_ids, _ = get_rope_index(
+            batch["input_ids"],
+            image_grid_thw=batch.get("image_grid_thw"),
+            attention_mask=batch["attention_mask"],
+        )
+        max_position_ids = position_ids.amax(dim=(0, 2)).tolist()
+        for r, max_position_id in zip(reqs, max_position_ids):
+            r.extra_kwargs["max_position_id"] = max_position_id
+        return position_ids
+
+    def build_decode_position_ids(
+        self, batch_size: int, seq_length: int, reqs: List[InferenceRequest]
+    ):
+        position_ids = super().build_decode_position_ids(batch_size, seq_length, reqs)
+        # new tokens are text, the three dimensions share the same position
+        return position_ids.unsqueeze(0).expand(3, -1, -1)
@@ -0,0 +1,299 @@
+# Copyright 2022-2023 XProbe Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+
+import pytest
+import torch
+
+from .....core.scheduler import InferenceRequest
+from ...llm_family import LLMFamilyV1, PytorchLLMSpecV1
+from ..qwen2_vl import (
+    MIN_STREAM_TIMEOUT,
+    PREPARED_INPUTS_CACHE_SIZE,
+    CancelledStoppingCriteria,
+    IncrementalTextStreamer,
+    Qwen2VLChatModel,
+)
+
+
+class MockByteTokenizer:
+    # every token id is a byte of the UTF-8 encoded text
+    def decode(self, token_ids, **kwargs):
+        return bytes(token_ids).decode("utf-8", errors="replace")
+
+
+class MockProcessor:
+    def __init__(self):
+        self.num_calls = 0
+
+    def apply_chat_template(self, messages, **kwargs):
+        self.num_calls += 1
+        return {"input_ids": torch.tensor([[len(messages[0]["content"][0]["text"])]])}
+
+
+class MockRopeModel:
+    # text positions only, the three dimensions share the same position
+    def get_rope_index(self, input_ids, image_grid_thw=None, attention_mask=None):
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        return position_ids.unsqueeze(0).expand(3, -1, -1), None
+
+
+def _get_model(quantization="none", **pytorch_model_config) -> Qwen2VLChatModel:
+    spec = PytorchLLMSpecV1(
+        model_format="pytorch",
+        model_size_in_billions=2,
+        quantizations=["4-bit", "8-bit", "none"],
+        model_id="Qwen/Qwen2-VL-2B-Instruct",
+    )
+    family = LLMFamilyV1(
+        version=1,
+        context_length=32768,
+        model_type="LLM",
+        model_name="qwen2-vl-instruct",
+        model_lang=["en", "zh"],
+        model_ability=["chat", "vision"],
+        model_specs=[spec],
+        chat_template=None,
+        stop_token_ids=None,
+        stop=None,
+    )
+    return Qwen2VLChatModel(
+        "qwen2_vl",
+        family,
+        spec,
+        quantization,
+        "/path/to/qwen2-vl",
+        pytorch_model_config,
+    )
+
+
+def _put_bytes(streamer, data: bytes):
+    for b in data:
+        streamer.put(torch.tensor([b]))
+
+
+def _drain(streamer):
+    texts = []
+    while not streamer.text_queue.empty():
+        texts.append(streamer.text_queue.get_nowait())
+    return texts
+
+
+def test_incremental_text_streamer():
+    streamer = IncrementalTextStreamer(MockByteTokenizer(), skip_prompt=True)
+    # the prompt
+    streamer.put(torch.tensor([[ord("h"), ord("i")]]))
+    assert _drain(streamer) == []
+
+    _put_bytes(streamer, b"a")
+    assert _drain(streamer) == ["a"]
+
+    # incomplete UTF-8 character is held back
+    data = "你".encode("utf-8")
+    _put_bytes(streamer, data[:2])
+    assert _drain(streamer) == []
+    _put_bytes(streamer, data[2:])
+    assert _drain(streamer) == ["你"]
+
+    streamer.end()
+    assert _drain(streamer) == [streamer.stop_signal]
+
+
+def test_incremental_text_streamer_flush_on_end():
+    streamer = IncrementalTextStreamer(MockByteTokenizer())
+    _put_bytes(streamer, b"a" + "你".encode("utf-8")[:2])
+    assert _drain(streamer) == ["a"]
+
+    streamer.end()
+    assert _drain(streamer) == ["\ufffd", streamer.stop_signal]
+
+
+def test_iter_chunks_by_size():
+    streamer = IncrementalTextStreamer(MockByteTokenizer(), timeout=1)
+    for text in "abcde":
+        streamer.text_queue.put(text)
+    streamer.text_queue.put(streamer.stop_signal)
+
+    assert list(streamer.iter_chunks(2, 10)) == ["ab", "cd", "e"]
+
+
+def test_iter_chunks_by_delay():
+    streamer = IncrementalTextStreamer(MockByteTokenizer(), timeout=1)
+
+    def produce():
+        streamer.text_queue.put("a")
+        time.sleep(0.2)
+        streamer.text_queue.put("b")
+        streamer.text_queue.put(streamer.stop_signal)
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    try:
+        assert list(streamer.iter_chunks(10, 0.01)) == ["a", "b"]
+    finally:
+        thread.join()
+
+
+def test_cancelled_stopping_criteria():
+    cancelled = threading.Event()
+    criteria = CancelledStoppingCriteria(cancelled)
+    input_ids = torch.ones(2, 3, dtype=torch.long)
+    assert criteria(input_ids, None).tolist() == [False, False]
+    cancelled.set()
+    assert criteria(input_ids, None).tolist() == [True, True]
+
+
+def test_quantization_config(monkeypatch):
+    monkeypatch.setattr("transformers.BitsAndBytesConfig", lambda **kw: kw)
+    monkeypatch.setattr(Qwen2VLChatModel, "_is_linux", staticmethod(lambda: True))
+
+    model = _get_model("4-bit")
+    model._device = "cuda"
+    config = model._get_quantization_config(torch.bfloat16)
+    assert config["load_in_4bit"] is True
+    assert config["bnb_4bit_compute_dtype"] == torch.bfloat16
+    assert config["llm_int8_skip_modules"] == ["visual", "lm_head"]
+
+    model = _get_model("8-bit", vision_quant_mode="same")
+    model._device = "cuda"
+    config = model._get_quantization_config(torch.bfloat16)
+    assert config == {"load_in_8bit": True}
+
+    model = _get_model("none")
+    model._device = "cuda"
+    assert model._get_quantization_config(torch.bfloat16) is None
+
+    # the config from user takes precedence
+    model = _get_model("4-bit", quantization_config={"load_in_8bit": True})
+    model._device = "cuda"
+    config = model._get_quantization_config(torch.bfloat16)
+    assert config == {
+        "load_in_8bit": True,
+        "llm_int8_skip_modules": ["visual", "lm_head"],
+    }
+
+    model = _get_model("4-bit", vision_quant_mode="fp8")
+    model._device = "cuda"
+    with pytest.raises(ValueError):
+        model._get_quantization_config(torch.bfloat16)
+
+    model = _get_model("4-bit")
+    model._device = "cpu"
+    with pytest.raises(ValueError):
+        model._get_quantization_config(torch.float32)
+
+
+def test_prepared_inputs_cache():
+    model = _get_model()
+    model._device = "cpu"
+    model._processor = MockProcessor()
+
+    def get_messages(i):
+        return [{"role": "user", "content": [{"type": "text", "text": "a" * i}]}]
+
+    for i in range(PREPARED_INPUTS_CACHE_SIZE + 1):
+        model._prepare_inputs(get_messages(i))
+    assert model._processor.num_calls == PREPARED_INPUTS_CACHE_SIZE + 1
+    assert len(model._inputs_cache) == PREPARED_INPUTS_CACHE_SIZE
+
+    # the most recently used entries are kept
+    model._prepare_inputs(get_messages(PREPARED_INPUTS_CACHE_SIZE))
+    assert model._processor.num_calls == PREPARED_INPUTS_CACHE_SIZE + 1
+    # the least recently used entry is evicted
+    model._prepare_inputs(get_messages(0))
+    assert model._processor.num_calls == PREPARED_INPUTS_CACHE_SIZE + 2
+
+
+def test_inputs_cache_key():
+    model = _get_model()
+
+    def get_messages(image):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "describe it"},
+                    {"type": "image", "image": image},
+                ],
+            }
+        ]
+
+    assert model._get_inputs_cache_key(get_messages("data:image/png;base64,AAAA"))
+    assert model._get_inputs_cache_key(get_messages("data:image/png;base64,AAAA")) != (
+        model._get_inputs_cache_key(get_messages("data:image/png;base64,BBBB"))
+    )
+    assert model._get_inputs_cache_key(get_messages("https://a.com/a.png")) is None
+    assert model._get_inputs_cache_key(get_messages("/path/to/a.png")) is None
+
+
+def test_stream_timeout():
+    model = _get_model()
+    assert model._get_stream_timeout(100, 100) == MIN_STREAM_TIMEOUT
+
+    model._prefill_token_time = 0.01
+    model._decode_token_time = 0.1
+    assert model._get_stream_timeout(100, 100) == MIN_STREAM_TIMEOUT
+    assert model._get_stream_timeout(1000, 1000) == pytest.approx(110)
+
+
+def _get_prefill_features():
+    return [
+        {
+            "input_ids": torch.tensor([[1, 2, 3]]),
+            "pixel_values": torch.ones(4, 2),
+            "image_grid_thw": torch.tensor([[1, 2, 2]]),
+        },
+        {"input_ids": torch.tensor([[4, 5, 6, 7, 8]])},
+    ]
+
+
+def test_build_prefill_kwargs():
+    model = _get_model()
+    model._device = "cpu"
+    model._model = MockRopeModel()
+    reqs = [InferenceRequest(None, None, True, "chat") for _ in range(2)]
+
+    kwargs = model.build_prefill_kwargs(_get_prefill_features(), reqs)
+    # left padded to the longest prompt
+    assert kwargs["input_ids"].tolist() == [[0, 0, 1, 2, 3], [4, 5, 6, 7, 8]]
+    assert [r.padding_len for r in reqs] == [2, 0]
+    assert [r.prompt_tokens for r in reqs] == [[1, 2, 3], [4, 5, 6, 7, 8]]
+    assert kwargs["attention_mask"].tolist() == [[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]]
+    # only the prompts with images contribute patches
+    assert kwargs["pixel_values"].shape == (4, 2)
+    assert kwargs["image_grid_thw"].tolist() == [[1, 2, 2]]
+
+    assert kwargs["position_ids"].shape == (3, 2, 5)
+    assert [r.extra_kwargs["max_position_id"] for r in reqs] == [2, 4]
+
+    position_ids = model.build_decode_position_ids(2, 1, reqs)
+    assert position_ids.shape == (3, 2, 1)
+    assert position_ids.tolist() == [[[3], [5]]] * 3
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires cuda")
+def test_build_prefill_inputs_on_mixed_devices():
+    model = _get_model()
+    model._device = "cuda"
+    features = _get_prefill_features()
+    # the second image is preprocessed on device and not cached
+    features[1]["pixel_values"] = torch.ones(4, 2, device="cuda")
+    features[1]["image_grid_thw"] = torch.tensor([[1, 2, 2]])
+    reqs = [InferenceRequest(None, None, True, "chat") for _ in range(2)]
+
+    batch = model.build_prefill_inputs(features, reqs)
+    assert batch["pixel_values"].shape == (8, 2)
+    assert batch["pixel_values"].device.type == "cuda"
+    assert batch["image_grid_thw"].tolist() == [[1, 2, 2], [1, 2, 2]]
@@ -344,6 +344,11 @@ class PytorchModelConfig(TypedDict, total=False):
     reasoning_content: bool
     min_pixels: NotRequired[int]
     max_pixels: NotRequired[int]
+    quantization_config: NotRequired[Optional[Dict[str, Any]]]
+    vision_quant_mode: NotRequired[str]
+    static_kv_cache: NotRequired[bool]
+    enable_cuda_graph: NotRequired[bool]
+    compile_vision_encoder: NotRequired[bool]
 
 
 def get_pydantic_model_from_method(